@@ -11,26 +11,61 @@ import traceback
 import atexit
 import subprocess
 import asyncio
+import functools
+import queue
 from typing import Any, Dict, List, Optional, Union, Generator, Tuple
 from dotenv import load_dotenv
 
-from app.modules.collector import SlotMachine, Response
+from app.modules.collector import SlotMachine, Response, int_to_bcd
 from app.modules.network.connection_server import client
 from app.modules.utils.codes import Codes
 from app.modules.collector.credits import CreditSender
-from app.modules.db import Database, read_json
+from app.modules.db import Database, read_json, insert_statement
 
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG, filename="main.log", filemode="w",
                     format="%(asctime)s %(levelname)s %(message)s")
 
+EXCHANGE_RATE_TTL = 300  # seconds before exchange rate is read from database again
+INSERT_BATCH = 500  # max gaming_transactions rows per insert
+INSERT_FLUSH_MS = 250  # how long queued rows wait for more rows before insert
+GAMING_TRANSACTIONS_COLUMNS = ('time_', 'mac', 'property_code', 'value', 'game_number', 'it_id')
+
+
+def _normalize_listener(value: Dict[str, Any]) -> Dict[str, Any]:
+    """Split listener from listeners.json into slot machine task and meter parameters."""
+    length_to_read_per_meter: Optional[Dict[str, int]] = value.get('length_to_read_per_meter')
+    return {
+        'meter': value['command'].lower(),
+        'commit': value.get('commit', False),
+        'task': {k: v for k, v in value.items() if k != 'length_to_read_per_meter'},
+        'length_to_read_per_meter': length_to_read_per_meter,
+        'information_codes': list(length_to_read_per_meter) if length_to_read_per_meter else None,
+        'old_data': dict.fromkeys(length_to_read_per_meter, 0) if length_to_read_per_meter else None,
+    }
+
+
+LISTENERS: List[Dict[str, Any]] = [_normalize_listener(v) for v in read_json('tasks', 'listeners.json')]
+
+
+@functools.cache
+def _machine_id() -> str:
+    """Return the unique machine ID from /var/lib/dbus/machine-id (read once)."""
+    with open("/var/lib/dbus/machine-id") as f:
+        return f.read().strip()
+
+
+@functools.cache
+def _host_name() -> str:
+    """Return the host name of this PC (resolved once)."""
+    return socket.gethostname()
+
 
 class Collector:
     """
     Main collector class for interacting with a slot machine, handling commands,
     sending jackpots, and persisting gaming machine data to the database.
     """
-    jackpot_meter: Dict[str, Any]
     gaming_transactions_table: Optional[str]
     db: Database
     slot_machine: SlotMachine
@@ -38,6 +73,7 @@ class Collector:
     pc_name: str
     commands: 'Commands'
     listening: bool = True
+    _exch_cache: Tuple[Optional[float], float]
 
     def __init__(
         self, 
@@ -65,17 +101,13 @@ class Collector:
             address (int): Address of the slot machine.
             wakeup_bit (int): Bit to wake the machine from idle state.
         """
-        self.jackpot_meter = {
-            "command": "8A",
-            "poll_type": "S",
-            "optional_data": []
-        }
         self.gaming_transactions_table = os.getenv('table_name')
+        self._exch_cache = (None, 0.0) # (exchange rate, monotonic time it was read)
 
         self.db = Database(host, user, password, database, driver)
         self.slot_machine = SlotMachine(com_port, baudrate, address, wakeup_bit)
         self.mac_address = str(self.get_unique_id()) or ''
-        self.pc_name = socket.gethostname() or ''
+        self.pc_name = _host_name() or ''
         
         self.commands = Commands(db=self.db, collector=self)
         
@@ -88,8 +120,7 @@ class Collector:
 
     def get_unique_id(self) -> str:
         """Return the unique machine ID from /var/lib/dbus/machine-id."""
-        with open("/var/lib/dbus/machine-id") as f:
-            return f.read().strip()
+        return _machine_id()
 
     def check_current_gaming_machine(self) -> None:
         """
@@ -97,9 +128,9 @@ class Collector:
         If not, insert them.
         """
         gaming_machine: List[Dict[str, Any]] = self.db.query_string__select(
-            f"SELECT * FROM GameMachines\
-            where PC_name = '{self.pc_name}' and \
-                serial_number = '{self.slot_machine.serial_number}' and mac = '{self.mac_address}'"
+            "SELECT * FROM GameMachines\
+            where PC_name = ? and serial_number = ? and mac = ?",
+            (self.pc_name, self.slot_machine.serial_number, self.mac_address)
         )
         log.info(gaming_machine)
         log.info(self.pc_name)
@@ -118,70 +149,80 @@ class Collector:
         
         Args:
             value (int | float | str): Amount won in machine's currency.
+        
+        Raises:
+            ValueError: If the converted amount is negative or does not fit into 4 BCD bytes.
         """
         log.info("jackpot called")
-        [[exchange_currency]] = self.db.select('exchange_rate', ['exchange_currency'])
-        log.info(exchange_currency)
-        exchange_currency_value: float = float(exchange_currency)
-        jackpot_value: str = str(int(float(value)/exchange_currency_value)).zfill(8)
-        log.info(f"jackpot value {jackpot_value}") 
+        exchange_currency_value: float = self.get_exchange_rate()
+        jackpot_value: bytes = int_to_bcd(int(float(value)/exchange_currency_value), 4)
+        log.info(f"jackpot value {jackpot_value.hex()}") 
         
         self.send_jackpot(jackpot_value)
 
-    def send_jackpot(self, jackpot_value: str) -> None:
+    def get_exchange_rate(self) -> float:
+        """Return exchange rate, reading it from database at most once per EXCHANGE_RATE_TTL."""
+        exchange_rate, read_at = self._exch_cache
+        now = time.monotonic()
+        if exchange_rate is None or now - read_at >= EXCHANGE_RATE_TTL:
+            [[exchange_currency]] = self.db.select('exchange_rate', ['exchange_currency'])
+            log.info(exchange_currency)
+            exchange_rate = float(exchange_currency)
+            self._exch_cache = (exchange_rate, now)
+        return exchange_rate
+
+    def invalidate_exchange_rate(self) -> None:
+        """Force the next jackpot to read exchange rate from database."""
+        self._exch_cache = (None, 0.0)
+
+    def send_jackpot(self, jackpot_value: bytes) -> None:
         """
         Prepare and send jackpot meter command to the slot machine.
         
         Args:
-            jackpot_value (str): Jackpot amount formatted as 8-digit string.
+            jackpot_value (bytes): Jackpot amount as 4-byte packed BCD.
         """
-        jackpot_meter: Dict[str, Any] = self.jackpot_meter.copy()
-        jackpot_meter['optional_data'] = [jackpot_value[i:i+2] for i in range(0, len(jackpot_value), 2)]
-        jackpot_meter['optional_data'].append('00')
-        jackpot_meter['response_type'] = "ack_nack"
-        
-        log.info(f"jackpot meter {jackpot_meter}")
-        self.slot_machine.add_one_task(**jackpot_meter)
+        optional_data: bytes = jackpot_value + b'\x00'
+        log.info(f"jackpot meter {optional_data.hex()}")
+        self.slot_machine.add_one_task(
+            command='8A', poll_type='S',
+            optional_data=optional_data, response_type='ack_nack')
             
-    def __call__(self) -> None:
-        """Continuously capture slot machine events and process them."""
-        for response in self.slot_machine.capture_events():  # type: ignore
+    async def __call__(self) -> None:
+        """Capture slot machine events and process them until on_exit is called."""
+        get = self.commands.meters.get # keys and response.command are lowercase hex
+        blank = BlankCommand()
+        async for response in self.slot_machine.capture_events():
+            if not self.listening:
+                break
             if response:
-                self.commands.get(response.command, BlankCommand).process_data(response)
+                (get(response.command) or blank).process_data(response)
     
     def add_listeners(self) -> None:
-        """Initialize listeners for slot machine commands based on JSON config."""
-        data: List[Dict[str, Any]] = read_json('tasks', 'listeners.json')
-        for value in data:
-            command: str = value['command']
-            commit: bool = value.get('commit', False)
+        """Initialize listeners for slot machine commands based on LISTENERS."""
+        for listener in LISTENERS:
+            meter: str = listener['meter']
+            task: Dict[str, Any] = listener['task']
 
-            kwargs: Dict[str, Any] = {'commit': commit}
-            if command.lower() == '2f':
+            kwargs: Dict[str, Any] = {'commit': listener['commit']}
+            if meter == '2f':
                 [[it_id]] = self.db.query_string__select(
                     'SELECT TOP 1 it_id FROM gaming_transactions ORDER BY ID DESC;'
                 ) or [[0]]
                 kwargs['it_id'] = it_id
-                kwargs['old_data'] = dict.fromkeys(list(value['length_to_read_per_meter'].keys()), '0')
+                kwargs['old_data'] = dict(listener['old_data'])
+            if listener['length_to_read_per_meter']:
+                kwargs['information_codes'] = listener['information_codes']
+                kwargs['length_to_read_per_meter'] = listener['length_to_read_per_meter']
                 
-            log.debug(f'command is {command} {kwargs}')
-
-            if "length_to_read_per_meter" in value:
-                self.commands.init_meter(
-                    command, 
-                    information_codes=list(value['length_to_read_per_meter'].keys()),
-                    length_to_read_per_meter=value.pop("length_to_read_per_meter"),
-                    **kwargs
-                )
-            else:
-                self.commands.init_meter(command, **kwargs)
+            log.debug(f'command is {meter} {kwargs}')
+            self.commands.init_meter(meter, **kwargs)
             
-            if command.lower() == '2f':
-                old_data: Dict[str, str] = self.get_prev_values_2f(value)
-                self.commands['2f'].old_data = old_data
+            if meter == '2f':
+                self.commands['2f'].old_data = self.get_prev_values_2f(task)
 
-            log.info(value)
-            self.slot_machine.add_listener(**value)
+            log.info(task)
+            self.slot_machine.add_listener(**task)
 
     def add_do_once(self) -> None:
         """Add tasks that should run only once on startup."""
@@ -221,7 +262,7 @@ class Commands(Codes):
     """
     Class for managing slot machine commands and their corresponding meters.
     """
-    meters: Dict[str, Any] = {}
+    meters: Dict[str, Any]
 
     def __init__(self, db: Database, collector: Collector) -> None:
         """
@@ -233,12 +274,58 @@ class Commands(Codes):
         """
         self.db: Database = db
         self.collector: Collector = collector
+        self.meters = {}
+        self._insert_q: queue.Queue = queue.Queue()
+        threading.Thread(target=self._flusher, daemon=True).start()
+        atexit.register(self.flush)
         super().__init__()
 
+    def save_transactions(self, rows: List[Tuple]) -> None:
+        """Queue gaming_transactions rows, they are inserted in batches by _flusher."""
+        for row in rows:
+            self._insert_q.put(row)
+
+    def flush(self) -> None:
+        """Block until every queued row is inserted."""
+        self._insert_q.join()
+
+    def _flusher(self) -> None:
+        """Insert queued rows every INSERT_BATCH rows or INSERT_FLUSH_MS, whichever comes first."""
+        while True:
+            rows: List[Tuple] = [self._insert_q.get()]
+            deadline: float = time.monotonic() + INSERT_FLUSH_MS / 1000
+            while len(rows) < INSERT_BATCH and (timeout := deadline - time.monotonic()) > 0:
+                try:
+                    rows.append(self._insert_q.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self.db.insert_many('gaming_transactions', GAMING_TRANSACTIONS_COLUMNS, rows)
+            except Exception as e:
+                log.error(e, exc_info=True)
+                try:
+                    # rows are replayed after reconnect or moved to dead letter file
+                    self.db.save_failed(
+                        insert_statement('gaming_transactions', GAMING_TRANSACTIONS_COLUMNS), rows, e)
+                except Exception as e:
+                    # flusher must keep running, flush() would never return otherwise
+                    log.critical(e, exc_info=True)
+            else:
+                # rows are committed, job error must not save them again
+                try:
+                    self.db.start_job()
+                except Exception as e:
+                    log.error(e, exc_info=True)
+            finally:
+                for _ in rows:
+                    self._insert_q.task_done()
+
     class _2f(Codes._2f):
         """
         Command 2F: Handles reading and saving counter values to database.
         """
+        __slots__ = ('db', 'collector', 'commit')
+
         def __init__(self, db: Database, collector: Collector,
                      commit: bool = True, *args: Any, **kwargs: Any) -> None:
             """
@@ -261,7 +348,7 @@ class Commands(Codes):
 
         def process_data(self, response: Response) -> None:
             """
-            Process and save counter data from slot machine to database.
+            Process counter data from slot machine and queue it for database.
             
             Args:
                 response (Response): Response from slot machine.
@@ -269,23 +356,19 @@ class Commands(Codes):
             log.debug('data processing in _2f')
             if not response or not self.commit:
                 return
-            for code, value in super().process_data(response):
-                log.debug(f'data processing in _2f {code} and {value}')
-                self.db.execute_with_check(self.db.insert)(
-                    'gaming_transactions', 
-                    (
-                        'time_', 
-                        'mac', 'property_code',
-                        'value', 'game_number',
-                        'it_id'
-                    ),
-                    (
-                        datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-4],
-                        self.collector.mac_address, code,
-                        value, ''.join(self.game_number),
-                        self.it_id
-                    )
-                )
+            new_values = list(super().process_data(response))
+            time_ = datetime.datetime.now().isoformat(sep=' ', timespec='milliseconds')
+            game_number = self.game_number.hex()
+            rows = []
+            debug = log.isEnabledFor(logging.DEBUG)
+            for code, value in new_values:
+                if debug:
+                    log.debug('data processing in _2f %s and %s', code, value)
+                rows.append((
+                    time_, self.collector.mac_address, code,
+                    value, game_number, self.it_id
+                ))
+            self.collector.commands.save_transactions(rows)
 
     def init_meter(self, meter: str, **kwargs: Any) -> None:
         """
@@ -307,8 +390,8 @@ class Commands(Codes):
         return self.meters[meter]
     
     def get(self, key: str, def_val: Any) -> Any:
-        """Return the command meter by key, or default if not found."""
-        return self.meters.get(key.lower(), def_val)        
+        """Return the command meter by lowercase key, or default if not found."""
+        return self.meters.get(key, def_val)        
    
    
 class BlankCommand:
@@ -318,6 +401,23 @@ class BlankCommand:
         pass
     
 
+def _log_task_error(task: asyncio.Task) -> None:
+    """Log the error a background task ended with, nothing else awaits it."""
+    if not task.cancelled() and (e := task.exception()) is not None:
+        log.critical(e, exc_info=e)
+
+
+async def main(collector: Collector) -> None:
+    """Run websocket client and serial capture on the same event loop."""
+    client_task = asyncio.create_task(client(collector))
+    client_task.add_done_callback(_log_task_error)
+    try:
+        await collector()
+    finally:
+        collector.on_exit()
+        client_task.cancel()
+
+
 if __name__ == '__main__':
     load_dotenv()
     
@@ -336,7 +436,6 @@ if __name__ == '__main__':
     try:
         collector: Collector = Collector(host, user, password, database, driver,
                                          com_port, baudrate, address, wakeup_bit)
-        asyncio.run(client(collector))
-        collector()
+        asyncio.run(main(collector))
     except Exception as e:
         log.critical(e, exc_info=True)
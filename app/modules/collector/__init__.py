@@ -1,6 +1,7 @@
 import time
 import datetime
-from typing import Generator, List
+import asyncio
+from typing import AsyncGenerator, List, Union
 import serial
 from app.modules.crc import CRC16Kermit as Kermit
 import atexit
@@ -11,6 +12,7 @@ log = logging.getLogger(__name__)
 READ_ITERATIONS = 5
 READ_DELAY = .1
 READ_SIZE_BYTES = 1
+RESPONSE_TIMEOUT = 1 # seconds to wait for the first byte of response in async polling
 CRC_LENGTH = 2
 BCD_GAME_NUMBER_LENGTH = 2
 
@@ -29,7 +31,7 @@ class IterationsExceeded(Exception):
 
 class Response:
     """The Response from Slot Machine"""
-    def __init__(self, data: List[str] = [], poll_type: str = [], error: bool = False,
+    def __init__(self, data: bytes = b'', poll_type: str = [], error: bool = False,
                  ack_nack: hex = None, command: int = 0) -> None:
         self.error = error
         self.raw_data = data
@@ -38,7 +40,9 @@ class Response:
         self.length_to_read = None
         self.command = command
         if not self.error and not ack_nack:
-            self.address, self.command, *self.data = data[:-CRC_LENGTH] 
+            # command as lowercase hex, so it is a ready meters key
+            self.address, self.command = data[0], format(data[1], '02x')
+            self.data = data[2:-CRC_LENGTH]
             self.crc = data[-CRC_LENGTH:]
             if poll_type == 'M':
                 self.length_to_read, self.data = self.data[0], self.data[1:]
@@ -46,6 +50,8 @@ class Response:
             self.raw_data = ['Error']
 
     def __str__(self) -> str:
+        if isinstance(self.raw_data, bytes):
+            return self.raw_data.hex(' ')
         return ' '.join(map(str, self.raw_data))
 
     def __iter__(self) -> iter:
@@ -63,9 +69,23 @@ class Response:
 
 kermit = Kermit().calculate
 
-def transform(data: List[int]) -> bytes:
+def transform(data: Union[List[int], bytes]) -> bytes:
     """Transforms data from list of integers to bytes"""
-    return bytes.fromhex(''.join(map(lambda x: hex(x)[2:].zfill(2), data)))
+    return bytes(data)
+
+def int_to_bcd(value: int, length: int) -> bytes:
+    """Packs value into length bytes of BCD, two decimal digits per byte, most significant first.
+    Raises ValueError if value is negative or does not fit into length bytes"""
+    if value < 0:
+        raise ValueError(f"negative value {value} can not be packed into BCD")
+    out = bytearray(length)
+    rest = value
+    for i in range(length - 1, -1, -1):
+        rest, digits = divmod(rest, 100)
+        out[i] = (digits // 10) << 4 | digits % 10
+    if rest:
+        raise ValueError(f"value {value} does not fit into {length} BCD bytes")
+    return bytes(out)
 
 def crc_calculate(command: List[int]) -> List[int]:
     """Calculates CRC16Kermit from list of integers"""
@@ -76,6 +96,9 @@ def crc_calculate(command: List[int]) -> List[int]:
     return crc_sliced
 
 def transform_optional_data(data):
+    """Hex strings from json tasks are converted to integers, bytes are passed as they are"""
+    if isinstance(data, (bytes, bytearray)):
+        return bytes(data)
     return list(map(lambda x: int(x, 16), data)) if data else []
 
 def transform_command(command):
@@ -112,38 +135,41 @@ class SlotMachine:
         
         atexit.register(self.on_exit)
 
-    def get_transformed_task(self, command: int, optional_data: List[str]=None, **kwargs):
+    def get_transformed_task(self, command: int, optional_data: Union[List[str], bytes]=None, **kwargs):
         return {
             'command' : transform_command(command), 
             'optional_data' : transform_optional_data(optional_data), 
             **kwargs
             }
 
-    def add_listener(self, command: int, optional_data: List[str]=None, **kwargs):
+    def add_listener(self, command: int, optional_data: Union[List[str], bytes]=None, **kwargs):
         """
         Adds task to listen.
         """
         self.listeners_tasks.append(self.get_transformed_task(command, optional_data, **kwargs))
 
-    def add_one_task(self, command: int, optional_data: List[str]=None, **kwargs):
+    def add_one_task(self, command: int, optional_data: Union[List[str], bytes]=None, **kwargs):
         """
         Adds task to listen.
         """
         self.single_shots_tasks.append(self.get_transformed_task(command, optional_data, **kwargs))
         
-    def capture_events(self) -> Generator[Response, None, None]:
+    async def capture_events(self) -> AsyncGenerator[Response, None]:
         """
         Interrogates the client.
+        Waits for responses on the event loop instead of blocking on the port.
         """
         while 1:
-            time.sleep(.5)
+            await asyncio.sleep(.5)
             tasks_log = {}
             log.info("single shots task")
-            for task in self.single_shots_tasks:
-                data = self.write(**task)
+            # tasks can be added from other threads, take current ones and leave an empty list for new
+            single_shots_tasks, self.single_shots_tasks = self.single_shots_tasks, []
+            for task in single_shots_tasks:
+                data = await self.write_async(**task)
                 print(data)
                 yield data
-                log.debug(self.single_shots_tasks)
+                log.debug(single_shots_tasks)
 
             for _id, task in enumerate(self.listeners_tasks):
                 log.debug('poll')      
@@ -151,11 +177,22 @@ class SlotMachine:
                 _t = task.pop('time') if 'time' in task else 0
                 if (datetime.datetime.now().now().second - (tasks_log[_id].second if _id in tasks_log else _t*(-1))) >= _t:
                     tasks_log[_id] = datetime.datetime.now()
-                    data = self.write(**task)
+                    data = await self.write_async(**task)
 
                 yield data
-                
-            self.single_shots_tasks = []
+
+    async def wait_readable(self, timeout: float) -> bool:
+        """Waits until the port has data to read. Returns False if timeout expired"""
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fd = self.port.fileno()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(True))
+        try:
+            return await asyncio.wait_for(ready, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(fd)
                 
     def write_type_R(self, command: int, length_to_read: int = 0, following_length: bool = False):
         return self.write(command, length_to_read=length_to_read, 
@@ -183,7 +220,7 @@ class SlotMachine:
                 time.sleep(1)
         return wrapper
         
-    def write(self, command: int, optional_data: List[int]=[], 
+    def write(self, command: int, optional_data: Union[List[int], bytes]=[], 
                length_to_read: int=0, poll_type: str = "", 
                BCD_game_number: List[int] = [0, 0], following_length: bool = False,
                add_length_binary: bool = False, response_type: str = 'normal', *args, **kwargs) -> Response:
@@ -193,6 +230,33 @@ class SlotMachine:
         Writes data to the client.
         length to read does not include the crc in output.
         """
+        self.send(command, optional_data, poll_type, BCD_game_number, add_length_binary)
+        return self.read(bytes.fromhex(hex(command)[2:].zfill(2)), poll_type = poll_type, 
+                         length_to_read = length_to_read, following_length = following_length,
+                         response_type = response_type)
+
+    async def write_async(self, command: int, optional_data: Union[List[int], bytes]=[], 
+                          length_to_read: int=0, poll_type: str = "", 
+                          BCD_game_number: List[int] = [0, 0], following_length: bool = False,
+                          add_length_binary: bool = False, response_type: str = 'normal', 
+                          *args, **kwargs) -> Response:
+        """
+        Same as write, but waits for the response on the event loop.
+        The port is read only when the machine started answering,
+        the rest of the frame is read in a thread, so the loop is not blocked.
+        """
+        self.send(command, optional_data, poll_type, BCD_game_number, add_length_binary)
+        command = bytes.fromhex(hex(command)[2:].zfill(2))
+        if not await self.wait_readable(RESPONSE_TIMEOUT):
+            log.debug('no response for {}'.format(command))
+            return Response(error=True, command=command)
+        return await asyncio.to_thread(self.read, command, poll_type = poll_type, 
+                                       length_to_read = length_to_read, following_length = following_length,
+                                       response_type = response_type)
+
+    def send(self, command: int, optional_data: Union[List[int], bytes]=[], poll_type: str = "", 
+             BCD_game_number: List[int] = [0, 0], add_length_binary: bool = False) -> None:
+        """Builds raw command with crc and writes it to the port"""
         log.debug('command {} and optdata {}'.format(command, optional_data))
         raw_command = self.wakeup_bit_and_address.copy()
 
@@ -214,9 +278,6 @@ class SlotMachine:
         log.debug('data {}'.format(data))
 
         self.port.write(data)
-        return self.read(bytes.fromhex(hex(command)[2:].zfill(2)), poll_type = poll_type, 
-                         length_to_read = length_to_read, following_length = following_length,
-                         response_type = response_type)
 
     def read(self, command: bytes, poll_type: str='', length_to_read: int = 0,
              following_length: bool = False, response_type: str = 'normal') -> Response:
@@ -246,11 +307,10 @@ class SlotMachine:
                     text += p_v_c
                     log.debug("Reading data {}".format(p_v_c))
 
-                data = bytes.hex(text, " ").split(' ')
-                log.debug('read data = {}'.format(data))
+                log.debug('read data = {}'.format(text))
 
                 self.validate_crc(text)
-                __R = Response(data, poll_type)
+                __R = Response(text, poll_type)
                 print("read data: ", __R)
                 return __R
             
@@ -268,7 +328,7 @@ class SlotMachine:
         response = self.write_type_R(0x54, following_length=True)
         
         if response:
-            serial_number = ''.join(response.data[3:])
+            serial_number = response.data[3:].hex()
             return serial_number
         
     def add_credits(self, credits: List[int]):
@@ -1,8 +1,28 @@
 from datetime import datetime
 import logging
+import struct
+from types import MappingProxyType
+
+from app.modules.collector import int_to_bcd
 
 log = logging.getLogger(__name__)
 
+_HDR = struct.Struct('>BBB')    # transfer code, transaction index, transfer type
+_ASSET = struct.Struct('>I')    # asset number
+_POOL = struct.Struct('>H')     # pool ID
+
+_TRANSFER_TYPES = MappingProxyType({
+    'EGM': 0x00,        # In-house to gaming machine
+    'TICKET': 0x20,     # In-house to ticket
+    'BONUS_COIN': 0x10, # Bonus coin out
+    'BONUS_JACKPOT': 0x11, # Bonus jackpot
+    'DEBIT_EGM': 0x40,  # Debit to EGM
+    'DEBIT_TICKET': 0x60, # Debit to ticket
+    'HOST': 0x80,       # Transfer to host
+    'WIN_HOST': 0x90    # Win amount to host
+})
+_DEBIT_TYPES = frozenset({0x40, 0x60})
+
 class CreditSender:
     """
     Handles Automated Funds Transfer (AFT) credit operations with a SlotMachine.
@@ -35,16 +55,6 @@ class CreditSender:
             slot_machine: An instance of SlotMachine used to communicate with the device.
         """
         self.slot_machine = slot_machine
-        self.transfer_types = {
-            'EGM': 0x00,        # In-house to gaming machine
-            'TICKET': 0x20,     # In-house to ticket
-            'BONUS_COIN': 0x10, # Bonus coin out
-            'BONUS_JACKPOT': 0x11, # Bonus jackpot
-            'DEBIT_EGM': 0x40,  # Debit to EGM
-            'DEBIT_TICKET': 0x60, # Debit to ticket
-            'HOST': 0x80,       # Transfer to host
-            'WIN_HOST': 0x90    # Win amount to host
-        }
 
     def _validate_transfer(self, config):
         """
@@ -61,7 +71,7 @@ class CreditSender:
         if config['cashable'] + config['restricted'] + config['nonrestricted'] == 0:
             raise ValueError("At least one amount must be non-zero")
         
-        if config['transfer_type'] in [0x40, 0x60] and not config.get('pos_id'):
+        if config['transfer_type'] in _DEBIT_TYPES and not config.get('pos_id'):
             raise ValueError("DEBIT transfers require POS ID")
         
         if len(config.get('transaction_id', '')) > 20:
@@ -72,24 +82,21 @@ class CreditSender:
         Build SAS command bytes for AFT transfer.
         
         Converts amounts, flags, asset number, registration keys, expiration, 
-        and other parameters into a SAS-compatible command byte list.
+        and other parameters into a SAS-compatible command.
         
         Args:
             config (dict): Transfer configuration with required fields.
         
         Returns:
-            List[int]: Byte list ready to send to the SlotMachine.
+            bytes: Command bytes ready to send to the SlotMachine.
         """
-        cmd = [
-            config['transfer_code'],    # 00=Full, 01=Partial
-            0x00,                       # Transaction index (new)
-            config['transfer_type']
-        ]
+        # Transfer code (00=Full, 01=Partial), transaction index (new), type
+        buf = bytearray(_HDR.pack(config['transfer_code'], 0x00, config['transfer_type']))
 
         # Add amounts (5-byte BCD each)
-        cmd.extend(self._amount_to_bcd(config['cashable']))
-        cmd.extend(self._amount_to_bcd(config['restricted']))
-        cmd.extend(self._amount_to_bcd(config['nonrestricted']))
+        buf += self._amount_to_bcd(config['cashable'])
+        buf += self._amount_to_bcd(config['restricted'])
+        buf += self._amount_to_bcd(config['nonrestricted'])
 
         # Transfer flags (bitmask)
         flags = 0
@@ -97,32 +104,32 @@ class CreditSender:
             flags |= 0x80
         if config.get('custom_ticket_data', False):
             flags |= 0x20
-        cmd.append(flags)
+        buf.append(flags)
 
         # Asset number (4 bytes)
-        cmd.extend(config['asset_number'].to_bytes(4, 'big'))
+        buf += _ASSET.pack(config['asset_number'])
 
         # Registration key (20 bytes) - zeros for non-debit
-        cmd.extend(config.get('registration_key', bytes(20)))
+        buf += config.get('registration_key', bytes(20))
 
         # Transaction ID
         txid = config.get('transaction_id', self._generate_txid())
-        cmd.append(len(txid))
-        cmd.extend(txid.encode('ascii'))
+        buf.append(len(txid))
+        buf += txid.encode('ascii')
 
         # Expiration (MMDDYYYY or days format)
-        cmd.extend(self._format_expiration(config.get('expiration')))
+        buf += self._format_expiration(config.get('expiration'))
 
         # Pool ID (2 bytes)
-        cmd.extend(config.get('pool_id', 0x0000).to_bytes(2, 'big'))
+        buf += _POOL.pack(config.get('pool_id', 0x0000))
 
         # Receipt data (if any)
-        cmd.extend(self._prepare_receipt_data(config.get('receipt_data')))
+        buf += self._prepare_receipt_data(config.get('receipt_data'))
 
         # Lock timeout (2-byte BCD)
-        cmd.extend(self._lock_timeout(config.get('lock_timeout')))
+        buf += self._lock_timeout(config.get('lock_timeout'))
 
-        return cmd
+        return bytes(buf)
 
     def send_credits(self, config):
         """
@@ -132,7 +139,7 @@ class CreditSender:
 
         Args:
             config (dict): Configuration dictionary containing:
-                - 'transfer_type': str, key from transfer_types
+                - 'transfer_type': str, key from _TRANSFER_TYPES
                 - 'cashable': int, cents
                 - 'restricted': int, cents
                 - 'nonrestricted': int, cents
@@ -149,7 +156,7 @@ class CreditSender:
         """
         try:
             # Validate and prepare
-            config['transfer_type'] = self.transfer_types[config['transfer_type']]
+            config['transfer_type'] = _TRANSFER_TYPES[config['transfer_type']]
             config['transfer_code'] = 0x01 if config.get('partial_allowed') else 0x00
             self._validate_transfer(config)
             
@@ -173,17 +180,17 @@ class CreditSender:
 
     def _amount_to_bcd(self, amount):
         """
-        Convert an integer amount (in cents) to a 5-byte BCD list.
+        Convert an integer amount (in cents) to 5-byte packed BCD.
         
         Args:
             amount (int): Amount in cents, max 9999999999
         
         Returns:
-            List[int]: 5-byte BCD representation of the amount.
+            bytes: 5-byte packed BCD (two decimal digits per byte).
         """
-        if amount < 0 or amount > 9999999999:
+        if not 0 <= amount <= 9999999999:
             raise ValueError("Amount out of range")
-        return [int(str(amount).zfill(10)[i:i+2]) for i in range(0, 10, 2)]
+        return int_to_bcd(amount, 5)
 
     def _format_expiration(self, expiration):
         """
@@ -193,19 +200,19 @@ class CreditSender:
             expiration (datetime | str | None): Expiration date or 'days' special format
         
         Returns:
-            List[int]: 4-byte BCD representation
+            bytes: 4-byte BCD representation
         """
         if isinstance(expiration, datetime):
-            return [
+            return bytes((
                 expiration.month,
                 expiration.day,
                 expiration.year // 100,
                 expiration.year % 100
-            ]
+            ))
         elif expiration == 'days':
-            return [0x00, 0x00, 0x00, 0x00]  # Special case
+            return bytes(4)  # Special case
         else:
-            return [0x00, 0x00, 0x00, 0x00]  # Default
+            return bytes(4)  # Default
 
     def _generate_txid(self):
         """Generate a unique transaction ID using current timestamp."""
@@ -219,9 +226,9 @@ class CreditSender:
             receipt_data: Optional receipt information
         
         Returns:
-            List[int]: Formatted receipt data bytes (empty in simplified example)
+            bytes: Formatted receipt data bytes (empty in simplified example)
         """
-        return []  # Simplified for example
+        return b''  # Simplified for example
 
     def _lock_timeout(self, seconds):
         """
@@ -231,10 +238,10 @@ class CreditSender:
             seconds (int | float): Timeout in seconds
         
         Returns:
-            List[int]: 2-byte BCD representation
+            bytes: 2-byte BCD representation
         """
         hundredths = int(seconds * 100)
-        return [(hundredths // 100) % 100, hundredths % 100]
+        return bytes(((hundredths // 100) % 100, hundredths % 100))
 
     def _handle_response(self, response):
         """
@@ -267,12 +274,15 @@ class CreditSender:
 
     def _bcd_to_int(self, bcd_bytes):
         """
-        Convert 5-byte BCD representation back to integer.
+        Convert 5-byte packed BCD representation back to integer.
         
         Args:
-            bcd_bytes (List[int]): 5-byte BCD list
+            bcd_bytes (List[int] | bytes): 5-byte packed BCD
         
         Returns:
             int: Integer value
         """
-        return int(''.join(f"{b:02d}" for b in bcd_bytes))
+        value = 0
+        for b in bcd_bytes:
+            value = value * 100 + (b >> 4) * 10 + (b & 0xF)
+        return value
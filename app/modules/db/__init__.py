@@ -1,32 +1,58 @@
 from typing import List
+import collections
+import copy
+import functools
+import itertools
+import random
 import time
 import json
+import queue
 import threading
 import os
 import logging
+import logging.handlers
+import atexit
 import pyodbc
 
 handler = logging.FileHandler("ms_connection.log")
 formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
 handler.setFormatter(formatter)
+# records are only queued by the caller, file is written from listener thread
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 l = logging.getLogger(__name__)
-l.addHandler(handler)
+l.addHandler(logging.handlers.QueueHandler(_log_queue))
 l.setLevel(logging.DEBUG)
 
 cur_dir = os.path.dirname(os.path.realpath(__file__))
 
-def repr_single(s):
-    return "'" + repr('"' + s)[2:] if type(s) is str else str(s)
+POOL_SIZE = 4 # max idle connections kept open for reuse
+OFFLINE_FILE = "tmp_db_data.jsonl" # queries saved while connection is lost, one json per line
+LEGACY_OFFLINE_FILE = "tmp_db_data.json" # json list of queries saved by older versions, imported on start
+DEAD_LETTER_FILE = "dead_db_data.jsonl" # queries that failed not because of connection, they are not retried
+OFFLINE_FLUSH_EVERY = 64 # saved queries that may stay in file buffer
+OFFLINE_FLUSH_SECONDS = 5 # or seconds since the last flush
+RECONNECT_BASE_DELAY = .1 # seconds, reconnect delay grows as base * 2 ** attempt
+RECONNECT_MAX_DELAY = 30 # seconds, upper bound for reconnect delay
+STATEMENTS_PER_CONNECTION = 16 # prepared statements (cursors) kept per pooled connection
+
+_threads_lock = threading.Lock()
 
 def in_thread(name):
-    """Create thread with name"""
+    """Create thread with name. It is not started again while the previous one is running"""
     def decorator(func):
         def wrapper(self, *args):
-            self.threads[name] = dict()
-            self.threads[name]['thread'] = \
-                threading.Thread(target=func, args=(self, *args))
-            self.threads[name]['running'] = True
-            self.threads[name]['thread'].start()
+            with _threads_lock:
+                if name in self.threads and self.threads[name]['running'] \
+                        and self.threads[name]['thread'].is_alive():
+                    return
+                self.threads[name] = dict()
+                self.threads[name]['thread'] = \
+                    threading.Thread(target=func, args=(self, *args))
+                self.threads[name]['running'] = True
+                self.threads[name]['thread'].start()
         return wrapper
     return decorator
 
@@ -38,41 +64,60 @@ def default_if_lost(default):
         return wrapper
     return decorator
 
-def CallStoredProc(conn, procName, *args):
-    sql = """SET NOCOUNT ON;
+def is_connection_error(e: Exception) -> bool:
+    """Connection failed (SQLSTATE 08xxx), the query itself may be fine"""
+    return isinstance(e, pyodbc.Error) and str(e.args[0] if e.args else '').startswith('08')
+
+@functools.lru_cache(maxsize=128)
+def _proc_sql(procName: str, nargs: int) -> str:
+    return """SET NOCOUNT ON;
          DECLARE @ret int
          EXEC @ret = %s %s
-         SELECT @ret""" % (procName, ','.join(['?'] * len(args)))
-    return conn.execute(sql, args).fetchall()
+         SELECT @ret""" % (procName, ','.join(['?'] * nargs))
+
+def CallStoredProc(conn, procName, *args):
+    return conn.execute(_proc_sql(procName, len(args)), args).fetchall()
+
+@functools.lru_cache(maxsize=None)
+def insert_statement(table: str, columns: tuple) -> str:
+    """Parameterized single-row INSERT, built once per (table, columns)"""
+    return f"INSERT INTO {table}({','.join(columns)}) VALUES ({','.join(['?'] * len(columns))})"
 
 def connect(func):
-    """Open and close connection"""
+    """Take connection from pool and return it back. Connection is dropped if query failed"""
     def wrapper(self, *args, **kwargs):
-        conn, cursor = self.open()
-        d = func(self, *args, conn=conn, cursor=cursor, **kwargs)
-        self.close(conn, cursor)
-        return d
-    return wrapper
-
-def choose_db(func):
-    def wrapper(self, query, _save=True, **kwargs):
-        """If connection is lost then adds query to json db.
-        Args:
-            query (_type_): query in str
-            _save (bool, optional): Save to json if lost . Defaults to True.
-        """        
-        if self.connection_is_lost and _save: return self.save_to_json(query)
-        else: func(self, query, **kwargs)
+        for attempt in range(2):
+            conn, cursor = self.open()
+            try:
+                d = func(self, *args, conn=conn, cursor=cursor, **kwargs)
+            except pyodbc.Error as e:
+                self.discard(conn, cursor)
+                if not is_connection_error(e):
+                    raise
+                if attempt:
+                    # server is unreachable, queries are saved until reconnect
+                    self.lose_connection()
+                    raise
+                # idle connection from pool could be dropped by server, retry once
+                self.clear_pool()
+                continue
+            self.close(conn, cursor)
+            return d
     return wrapper
 
-def read_json(*names: str):
-    with open(os.path.join(cur_dir, *names), 'r') as f:
+@functools.lru_cache(maxsize=32)
+def _load_json(path: str, mtime_ns: int, size: int):
+    """Parsed file content. mtime and size are part of the key, so a changed file is read again"""
+    with open(path, 'r') as f:
         data = json.load(f)
     return data
 
-def write_json(data:dict, *names: str):
-    with open(os.path.join(cur_dir, *names), 'w') as f:
-        json.dump(data, f)
+def read_json(*names: str):
+    path = os.path.join(cur_dir, *names)
+    stat = os.stat(path)
+    # callers may mutate the result, cached data must stay untouched
+    return copy.deepcopy(_load_json(path, stat.st_mtime_ns, stat.st_size))
+
 
 def open_connection(host, user, password, database, DRIVER="{ODBC Driver 17 for SQL Server}"):
     return pyodbc.connect(f"DRIVER={DRIVER};SERVER={host};DATABASE={database};UID={user};PWD={password};TrustServerCertificate=YES")
@@ -107,114 +152,340 @@ class Database:
         self.host, self.user, self.password, self.database, self.driver = \
             host, user, password, database, driver
         self.threads = dict()
+        self._pool = queue.LifoQueue(maxsize=POOL_SIZE)
+        # connection -> {query_string: cursor}, cursor keeps its statement prepared while the query is the same
+        self._statements = {}
+        self._offline_lock = threading.Lock()
+        # one replay at a time, queries are popped from queue only after they are committed
+        self._replay_lock = threading.Lock()
+        self._offline_fp = None
+        self._offline_pending = 0
+        self._offline_flushed_at = time.monotonic()
+        # pending offline queries, file is only their durable copy
+        self._offline = collections.deque(self._read_offline())
+        self._import_legacy_offline()
+        atexit.register(self.persist_offline)
+        self._offline_stopped = threading.Event()
+        threading.Thread(target=self._flush_offline_periodically, daemon=True).start()
         
         #check for tmp data
         self.send_data_json_db()
         
     def open(self):
+        """Idle connection from pool or a new one"""
         if not self.connection_is_lost:
+            while True:
+                try:
+                    conn, cursor = self._pool.get_nowait()
+                except queue.Empty:
+                    break
+                if not conn.closed:
+                    return conn, cursor
+                self._statements.pop(conn, None)
             try:
                 conn = open_connection(self.host, self.user, self.password, self.database, self.driver)
                 cursor = conn.cursor()
+                cursor.fast_executemany = True # executemany sends all rows in one parameter array
                 self.connection_is_lost = False
                 return conn, cursor
                 
             except Exception as e:
                 l.error(e)
-                self.conn = FailedConnection(self, self.host, self.user, self.password, self.database, self.driver)
-                self.connection_is_lost = True
-                self.start_reconnecting()
+                self.lose_connection()
         return (None, None)
+
+    def lose_connection(self):
+        """Mark connection as lost and reconnect in background"""
+        self.conn = FailedConnection(self, self.host, self.user, self.password, self.database, self.driver)
+        self.connection_is_lost = True
+        self.start_reconnecting()
                 
-    @default_if_lost(None)
     def close(self, conn, cursor):
-        cursor.close()
-        conn.close()
+        """Return connection to pool, it is closed if pool is full"""
+        if conn is None:
+            return
+        try:
+            self._pool.put_nowait((conn, cursor))
+        except queue.Full:
+            self.discard(conn, cursor)
+
+    def discard(self, conn, cursor):
+        """Close connection without returning it to pool"""
+        if conn is None:
+            return
+        try:
+            for statement in self._statements.pop(conn, {}).values():
+                statement.close()
+            cursor.close()
+            conn.close()
+        except pyodbc.Error as e:
+            l.debug(e)
+
+    def statement(self, conn, query_string: str):
+        """Cursor of conn dedicated to query_string, so pyodbc does not prepare it again"""
+        statements = self._statements.setdefault(conn, {})
+        cursor = statements.get(query_string)
+        if cursor is None:
+            if len(statements) >= STATEMENTS_PER_CONNECTION:
+                statements.pop(next(iter(statements))).close()
+            cursor = statements[query_string] = conn.cursor()
+            cursor.fast_executemany = True
+        return cursor
+
+    def clear_pool(self):
+        """Close all idle connections, f.e. they are stale after connection was lost"""
+        while True:
+            try:
+                self.discard(*self._pool.get_nowait())
+            except queue.Empty:
+                break
 
     @in_thread('r')
     def start_reconnecting(self) -> None:
-        """Tries to reconnect to the database"""
+        """Tries to reconnect to the database with exponential backoff and full jitter"""
+        attempt = 0
         while self.threads['r']['running']:
             try:
                 l.debug('is trying to reconnect')
                 self.conn.reconnect()
+                self.clear_pool()
                 self.connection_is_lost = False
                 self.send_data_json_db()
-                break
             except pyodbc.Error:
-                time.sleep(1)
+                pass
+            else:
+                # connection could be lost again during replay, start_reconnecting is skipped then
+                with _threads_lock:
+                    if not self.connection_is_lost:
+                        self.threads['r']['running'] = False
+                        break
+            time.sleep(random.random() * min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** min(attempt, 16)))
+            attempt += 1
 
     def send_data_json_db(self) -> None:
-        """Rewrites data from json to db"""
-        data = read_json("tmp_db_data.json")
-        for query in data:
-            self.query_string__insert(query)
-        write_json([], "tmp_db_data.json")
+        """Rewrites saved offline queries to db"""
+        with self._replay_lock:
+            with self._offline_lock:
+                if not self._offline:
+                    return
+                data = list(self._offline)
+            try:
+                done = len(data) if self._replay(data) else 0
+            except Exception as e:
+                l.error(e)
+                # a query failing by itself would block the queue on every replay
+                done = 0 if self._connection_failed(e) else self._replay_each(data)
+            if done:
+                # queries stay in queue and file until committed, the ones saved meanwhile are kept
+                with self._offline_lock:
+                    for _ in range(done):
+                        self._offline.popleft()
+                    self._write_offline()
+
+    def _replay_each(self, data: list) -> int:
+        """Replays queries one by one, the failing ones are moved to dead letter file. 
+        Returns how many queries from the start of data are done"""
+        for done, query in enumerate(data):
+            try:
+                if not self._replay([query]):
+                    return done
+            except Exception as e:
+                if self._connection_failed(e):
+                    return done
+                self._dead_letter([query], e)
+        return len(data)
+
+    @connect
+    @default_if_lost(False)
+    def _replay(self, data: list, **k) -> bool:
+        """Executes saved queries in one transaction. 
+        Consecutive parameterized entries with the same query go in one executemany"""
+        conn, cursor = k['conn'], k['cursor']
+        # parameterized queries are stored as [query_string, params], plain ones as str
+        for query_string, group in itertools.groupby(
+                data, key=lambda query: query[0] if isinstance(query, list) else None):
+            if query_string is None:
+                for query in group: cursor.execute(query)
+            else:
+                self.statement(conn, query_string).executemany(query_string, [params for _, params in group])
+        conn.commit()
+        return True
         
     def save_to_json(
         self,
-        query_string: str
+        query_string: str,
+        *params: list
     ) -> None:
-        data = read_json("tmp_db_data.json")
-        data.append(query_string)
-        write_json(data, "tmp_db_data.json")
+        """Adds query to offline queue and appends it to json lines file. 
+        Params are saved as separate [query_string, params] entries, one per set"""
+        entries = [[query_string, list(p)] for p in params] if params else [query_string]
+        with self._offline_lock:
+            self._offline.extend(entries)
+            if self._offline_fp is None:
+                self._offline_fp = open(os.path.join(cur_dir, OFFLINE_FILE), 'ab', buffering=128 * 1024)
+            for entry in entries:
+                self._offline_fp.write(json.dumps(entry).encode() + b"\n")
+            self._offline_pending += len(entries)
+            if self._offline_pending >= OFFLINE_FLUSH_EVERY or \
+                    time.monotonic() - self._offline_flushed_at >= OFFLINE_FLUSH_SECONDS:
+                self._flush_offline()
+
+    def save_failed(self, query_string: str, rows: list, error: Exception) -> None:
+        """Keeps rows of failed query. They are replayed after reconnect if connection failed, 
+        other errors would repeat on every replay, so rows go to dead letter file"""
+        if self._connection_failed(error):
+            self.save_to_json(query_string, *rows)
+            # reconnect thread could have replayed queue before rows were saved
+            if not self.connection_is_lost:
+                self.send_data_json_db()
+        else:
+            self._dead_letter([[query_string, list(row)] for row in rows], error)
+
+    def _connection_failed(self, error: Exception) -> bool:
+        """Error is caused by connection, not by the query"""
+        return self.connection_is_lost or is_connection_error(error)
+
+    def _dead_letter(self, entries: list, error: Exception) -> None:
+        """Appends queries to dead letter file, they are not replayed"""
+        l.error(f"{len(entries)} queries moved to {DEAD_LETTER_FILE}: {error}")
+        with self._offline_lock:
+            with open(os.path.join(cur_dir, DEAD_LETTER_FILE), 'ab') as f:
+                f.write(b''.join(json.dumps(entry, default=str).encode() + b"\n" for entry in entries))
+
+    def persist_offline(self) -> None:
+        """Overwrites json lines file with the offline queue"""
+        with self._offline_lock:
+            self._write_offline()
+
+    def _flush_offline(self) -> None:
+        """Writes buffered offline queries to file, _offline_lock must be held"""
+        if self._offline_fp is not None:
+            self._offline_fp.flush()
+        self._offline_pending = 0
+        self._offline_flushed_at = time.monotonic()
+
+    def _write_offline(self) -> None:
+        """Same as persist_offline, _offline_lock must be held"""
+        if self._offline_fp is not None:
+            self._offline_fp.close()
+            self._offline_fp = None
+        with open(os.path.join(cur_dir, OFFLINE_FILE), 'wb') as f:
+            f.write(b''.join(json.dumps(entry).encode() + b"\n" for entry in self._offline))
+        self._offline_pending = 0
+        self._offline_flushed_at = time.monotonic()
+
+    def _flush_offline_periodically(self) -> None:
+        """Writes buffered offline queries to file at least every OFFLINE_FLUSH_SECONDS"""
+        while not self._offline_stopped.wait(OFFLINE_FLUSH_SECONDS):
+            with self._offline_lock:
+                if self._offline_pending:
+                    self._flush_offline()
+
+    def _import_legacy_offline(self) -> None:
+        """Moves queries from json file of older versions to the start of offline queue"""
+        path = os.path.join(cur_dir, LEGACY_OFFLINE_FILE)
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r') as f:
+                queries = json.load(f)
+        except json.JSONDecodeError as e:
+            l.error(f"{LEGACY_OFFLINE_FILE} is not imported: {e}")
+            return
+        with self._offline_lock:
+            self._offline.extendleft(reversed(queries))
+            self._write_offline()
+        os.remove(path)
+
+    def _read_offline(self) -> list:
+        """Queries left in json lines file by previous run. 
+        Unparseable lines, f.e. the last one cut by a crash, are skipped"""
+        path = os.path.join(cur_dir, OFFLINE_FILE)
+        if not os.path.exists(path):
+            return []
+        queries = []
+        with open(path, 'r') as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    queries.append(json.loads(line))
+                except json.JSONDecodeError as e:
+                    l.error(f"skipped line {number} of {OFFLINE_FILE}: {e}")
+        return queries
         
     def select(self, table: str, columns: list) -> list:
         query_string = f"SELECT {(','.join(columns))} FROM {table}"
         return self.query_string__select(query_string)
     
     def insert(self, table: str, columns: list, data: list, _save=True) -> None:
-        query_string = f"INSERT INTO {table}({(','.join(columns))})\
-            VALUES ({','.join([repr_single(x) for x in data])})"
-        self.query_string__insert(query_string, _save)
+        self.insert_many(table, columns, [list(data)], _save=_save)
+
+    def insert_many(self, table: str, columns: list, rows: list, _save=True) -> None:
+        """Insert all rows in one batch (executemany with fast_executemany)"""
+        if not rows:
+            return
+        self.query_string__insert_many(insert_statement(table, tuple(columns)), rows, _save=_save)
             
     @connect
     @default_if_lost([])
     def call_proc(self, proc, args=[], q=True, **k) -> List:
         """q: query or not"""
-        sql = f"exec {proc} {' '.join(args) if len(args) != 0 else ''}"
+        sql = f"exec {proc} {','.join('?' * len(args))}"
         conn, cursor = k['conn'], k['cursor']
-        cursor.execute(sql)
+        if args: cursor.execute(sql, args)
+        else: cursor.execute(sql)
         results = cursor.fetchall() if q else None
         conn.commit()
         return results
     
     @connect
-    @choose_db
-    def query_string__insert(self, query_string: str, _save=True, q=True, **k) -> None | list:
-        return self._execute(k['conn'], k['cursor'], query_string, q=False)
+    def query_string__insert_many(self, query_string: str, rows: list, _save=True, **k) -> None:
+        """Execute one parameterized query for every row in rows"""
+        if self.connection_is_lost:
+            if _save: self.save_to_json(query_string, *rows)
+            return
+        conn = k['conn']
+        self.statement(conn, query_string).executemany(query_string, rows)
+        conn.commit()
     
     @connect
     @default_if_lost([])
-    def query_string__select(self, query_string: str, q=True, **k) -> None | list:
-        return self._execute(k['conn'], k['cursor'], query_string, q)
+    def query_string__select(self, query_string: str, params=(), q=True, **k) -> None | list:
+        return self._execute(k['conn'], k['cursor'], query_string, q, params=params)
     
-    def _execute(self, conn, cursor, query_string: str, q:bool=True) -> None | list:
+    def _execute(self, conn, cursor, query_string: str, q:bool=True, params=()) -> None | list:
         """Execute query
         Args:
             q (bool): if true then is query otherwise false(no fetch)
+            params (sequence): parameters for ? placeholders in query_string
         Returns:
             None | list: data or nothing(in case of insert)
         """
-        cursor.execute(query_string)
+        # parameterized queries are the recurring ones, they get a prepared statement
+        if params:
+            cursor = self.statement(conn, query_string)
+            cursor.execute(query_string, params)
+        else: cursor.execute(query_string)
         response = cursor.fetchall() if q else None
         conn.commit()
         return response
 
     def get_where(self, table: str, columns: list, values: list) -> None | list:
-        values = [repr_single(x) for x in values]
-        _where = " AND ".join(
-            f"{name} = {value}" for name, value in zip(columns, values))
+        _where = " AND ".join(f"{name} = ?" for name in columns)
         query_string = f'SELECT * FROM {table} WHERE {_where};'
-        return self.query_string__select(query_string)
+        return self.query_string__select(query_string, list(values))
     
     def stop_threads(self):
         for thread in self.threads.values():
             thread['running'] = False
+        self._offline_stopped.set()
+        self.persist_offline()
 
-    def _except_t_job_error(self):
+    def start_job(self):
+        """Start MS_SQL2MS_SQL job, 42000 (f.e. job is already running) is ignored"""
         try:
-            self.call_proc("msdb.dbo.sp_start_job", ["'MS_SQL2MS_SQL'"], q = False)
+            self.call_proc("msdb.dbo.sp_start_job", ["MS_SQL2MS_SQL"], q = False)
         except pyodbc.Error as ex:
             if ex.args[0] != '42000':
                 raise pyodbc.Error(ex)
@@ -223,6 +494,6 @@ class Database:
         """Check whether mssql to sql works and execute. Decorator """
         def wrapper(*args, **kwargs):
             v = func(*args, **kwargs)
-            self._except_t_job_error()
+            self.start_job()
             return v
         return wrapper
@@ -1,8 +1,10 @@
 import asyncio
+import concurrent.futures
 import websockets
 import logging
 import os
 import json
+import orjson
 import time
 import hmac
 import sys
@@ -12,6 +14,10 @@ logging.basicConfig(level=logging.INFO)
 load_dotenv()
 SIGNATURE_SKEW = int(os.getenv("WS_SIGNATURE_SKEW", 60))
 API_KEY = os.getenv("API_KEY")
+# actions may block on database, they run here so websocket keeps receiving
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+# keyed once, every message is signed on a copy
+_BASE_MAC = hmac.new(API_KEY.encode(), digestmod="sha256") if API_KEY else None
 
 def dispatch_action(payload: dict, collector):
     action = payload.get("action", "")
@@ -19,46 +25,70 @@ def dispatch_action(payload: dict, collector):
     if action == "jackpot":
         collector.jackpot(data.get("value"))
         return {"message": "Success", "status": 200}
+    if action == "exchange_rate":
+        collector.invalidate_exchange_rate()
+        return {"message": "Success", "status": 200}
 
 def verify_signature(payload: dict, signature: str, timestamp: str) -> bool:
-    ts = int(timestamp)
+    # cheap checks first, malformed frames are rejected before json.dumps and HMAC
+    if not isinstance(signature, str) or len(signature) != 64 or not isinstance(payload, dict):
+        return False
+    try:
+        sig_bytes = bytes.fromhex(signature)
+        ts = int(timestamp)
+    except (TypeError, ValueError):
+        return False
     now = int(time.time())
     if abs(now - ts) > SIGNATURE_SKEW:
         logging.warning("Timestamp skew too large")
         return False
+    if _BASE_MAC is None:
+        logging.warning("API_KEY is not set")
+        return False
     payload_text = json.dumps(payload, separators=(",", ":"), sort_keys=True)
-    msg = f"{timestamp}{payload_text}".encode()
-    mac = hmac.new(API_KEY.encode(), msg, digestmod="sha256").hexdigest()
-    return hmac.compare_digest(mac, signature)
+    mac = _BASE_MAC.copy()
+    mac.update(f"{timestamp}{payload_text}".encode())
+    return hmac.compare_digest(mac.digest(), sig_bytes)
+
+async def handle_message(message, collector) -> dict:
+    try:
+        data = orjson.loads(message)
+        signature = data.get("signature")
+        timestamp = data.get("timestamp")
+        payload = data.get("payload")
+        status_code = 200
+    
+        if verify_signature(payload, signature, timestamp):
+            result = await asyncio.get_running_loop().run_in_executor(
+                executor, dispatch_action, payload, collector)
+            if isinstance(result, dict) and isinstance(result.get("status"), int):
+                status_code = result.pop("status")
+        else:
+            status_code = 404
+            result = {"message": "Incorrect signature"}
+
+        response = {
+            "status": status_code,
+            "result": result,
+            "payload": payload,
+            "signature": signature,
+            "timestamp": timestamp,
+        }
+        return response
+    except Exception:
+        # handled in a task nobody awaits, error would be lost otherwise
+        logging.exception("Failed to handle message")
+        return {"status": 500, "result": {"message": "Internal error"}}
 
 async def client(collector):
     uri = os.getenv("WS_SERVER_URL")
+    handling = set() # strong references to running handle_message tasks
 
     async with websockets.connect(uri) as ws:
         while True:
             message = await ws.recv()
             logging.info(message)
-            
-            data = json.loads(message)
-            signature = data.get("signature")
-            timestamp = data.get("timestamp")
-            payload = data.get("payload")
-            status_code = 200
-            
-            if verify_signature(payload, signature, timestamp):
-                result = dispatch_action(payload, collector)    
-                if isinstance(result, dict) and isinstance(result.get("status"), int):
-                    status_code = result.pop("status")
-            else:
-                status_code = 404
-                result = {"message": "Incorrect signature"}
-
-            response = {
-                "status": status_code,
-                "result": result,
-                "payload": payload,
-                "signature": signature,
-                "timestamp": timestamp,
-            }    
-            
-
+            # next message is received while this one is handled
+            task = asyncio.create_task(handle_message(message, collector))
+            handling.add(task)
+            task.add_done_callback(handling.discard)
@@ -16,6 +16,9 @@ def validate_response(func):
 
 class Codes:
     class _2f:
+        __slots__ = ('length_to_read_per_meter', 'information_codes', 'old_data', 'it_id', 'game_number',
+                     '_plan', '_plan_length')
+
         def __init__(self, information_codes:list, length_to_read_per_meter:Dict,
                         old_data:Dict = None, it_id: int = 0, ) -> None:
             #bytes to read per every meter in 2f, f.e. 24 is 4 bytes(mostly every meter is 4bytes but...)
@@ -24,46 +27,61 @@ class Codes:
             #codes to read, mostly information_codes are length_to_read_per_meter keys
             self.information_codes = information_codes
 
-            #old data for finding new values from responde
-            self.old_data = old_data or dict.fromkeys(self.information_codes, '0')
+            #old data for finding new values from responde, meter values as int
+            self.old_data = old_data or dict.fromkeys(self.information_codes, 0)
 
             #it_id is used for database, to split every poll into blocks
             self.it_id = it_id
 
             #current game number for data
             self.game_number = 0
+
+            #(meter, tag in response, start, end) for every meter, response has tag byte and then meter bytes
+            self._plan = []
+            offset = 0
+            for code in self.information_codes:
+                length = self.length_to_read_per_meter[code]
+                self._plan.append((code, int(code, 16), offset + 1, offset + 1 + length))
+                offset += 1 + length
+            self._plan_length = offset
             
         def process_data(self, response):
 
             """find new values from machine's response, then yield it """
-            log.info(f"it id is {self.it_id}")
+            log.info("it id is %s", self.it_id)
 
             self.it_id += 1
-            log.info(f"it id is {self.it_id}")
-            log.info(response.data)
+            log.info("it id is %s", self.it_id)
+            if log.isEnabledFor(logging.INFO):
+                log.info(response.data)
             self.game_number, cleaned_data = response.data[:2], \
                                         self.get_clean_data(response.data[2:]) # 2 is Game number
-            log.info('clean_data')
-            log.debug(cleaned_data) 
+            debug = log.isEnabledFor(logging.DEBUG)
+            if debug: log.debug('clean_data %s', cleaned_data)
+            old_data = self.old_data
             for code in self.information_codes:
-                if cleaned_data[code] != self.old_data[code] and cleaned_data[code] != 0:
-                    value = int(cleaned_data[code]) - int(self.old_data[code])
-                    log.debug(f'value is {value}')
+                current = int(cleaned_data[code])
+                previous = old_data.get(code, 0)
+                if current != previous and current != 0:
+                    value = current - previous
+                    if debug: log.debug('value is %s', value)
                     yield code, value
-                    self.old_data[code] = cleaned_data[code]
+                    old_data[code] = current
 
-        def get_clean_data(self, raw_data: list) -> Dict[str, str]:
-            """Split data into blocks of meters from 2f"""
+        def get_clean_data(self, raw_data: bytes) -> Dict[str, str]:
+            """Split data into blocks of meters from 2f, meter values are BCD as hex strings"""
+            plan = self._plan
+            raw = memoryview(raw_data)
+            if len(raw) == self._plan_length and all(raw[start - 1] == tag for _, tag, start, _ in plan):
+                return {code: raw[start:end].hex() for code, _, start, end in plan}
+            # meters came in other order than requested
             cleaned_data = {}
-            pointer = iter(raw_data)
-            while (meter := next(pointer, None)):
-                cleaned_data[meter] = ''.join(
-                    [
-                        next(pointer)\
-                        for _ in range(self.length_to_read_per_meter[meter])
-                    ]
-                    )
-                """Get only needed information from data"""
+            pointer = 0
+            while pointer < len(raw):
+                meter = format(raw[pointer], '02x')
+                end = pointer + 1 + self.length_to_read_per_meter[meter]
+                cleaned_data[meter] = raw[pointer + 1:end].hex()
+                pointer = end
             return cleaned_data  
         
 
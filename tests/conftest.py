@@ -0,0 +1,18 @@
+import sys
+import types
+
+# Database is tested against fake connections, the ODBC driver is not needed
+try:
+    import pyodbc
+except ImportError:
+    pyodbc = types.ModuleType("pyodbc")
+
+    class Error(Exception):
+        pass
+
+    def connect(*args, **kwargs):
+        raise Error("08001", "pyodbc is not installed")
+
+    pyodbc.Error = Error
+    pyodbc.connect = connect
+    sys.modules["pyodbc"] = pyodbc
@@ -0,0 +1,35 @@
+import pytest
+
+from app.modules.collector import int_to_bcd
+from app.modules.collector.credits import CreditSender
+
+
+sender = CreditSender(slot_machine=None)
+
+
+@pytest.mark.parametrize("value, length, expected", [
+    (0, 4, b'\x00\x00\x00\x00'),
+    (12, 1, b'\x12'),
+    (1234, 4, b'\x00\x00\x12\x34'),
+    (99999999, 4, b'\x99\x99\x99\x99'),
+    (9999999999, 5, b'\x99\x99\x99\x99\x99'),
+])
+def test_int_to_bcd(value, length, expected):
+    assert int_to_bcd(value, length) == expected
+
+
+@pytest.mark.parametrize("value", [0, 1, 10, 500, 123456789, 9999999999])
+def test_bcd_round_trip(value):
+    assert sender._bcd_to_int(int_to_bcd(value, 5)) == value
+
+
+@pytest.mark.parametrize("value, length", [(-1, 4), (-5, 4), (100000000, 4), (100, 1)])
+def test_int_to_bcd_out_of_range(value, length):
+    with pytest.raises(ValueError):
+        int_to_bcd(value, length)
+
+
+@pytest.mark.parametrize("amount", [-1, 10000000000])
+def test_amount_to_bcd_out_of_range(amount):
+    with pytest.raises(ValueError):
+        sender._amount_to_bcd(amount)
@@ -0,0 +1,37 @@
+from types import SimpleNamespace
+
+from app.modules.utils.codes import Codes
+
+
+CODES = ["24", "00", "01"]
+
+
+def make_2f(old_data=None):
+    return Codes._2f(CODES, dict.fromkeys(CODES, 4), old_data=old_data)
+
+
+def response(data: bytes):
+    return SimpleNamespace(data=data)
+
+
+def test_get_clean_data_planned_order():
+    raw = bytes([0x24, 0, 0, 1, 0x23, 0x00, 0, 0, 0, 5, 0x01, 0, 0, 0, 0])
+    assert make_2f().get_clean_data(raw) == {"24": "00000123", "00": "00000005", "01": "00000000"}
+
+
+def test_get_clean_data_reordered():
+    raw = bytes([0x01, 0, 0, 0, 7, 0x24, 0, 0, 0, 9, 0x00, 0, 0, 0, 1])
+    assert make_2f().get_clean_data(raw) == {"01": "00000007", "24": "00000009", "00": "00000001"}
+
+
+def test_process_data_yields_deltas():
+    _2f = make_2f(old_data={"24": 100, "00": 5, "01": 0})
+    game_number = b'\x00\x12'
+    raw = bytes([0x24, 0, 0, 1, 0x23, 0x00, 0, 0, 0, 5, 0x01, 0, 0, 0, 0])
+    assert list(_2f.process_data(response(game_number + raw))) == [("24", 23)]
+    assert _2f.game_number == game_number
+    assert _2f.old_data == {"24": 123, "00": 5, "01": 0}
+    assert _2f.it_id == 1
+
+    raw = bytes([0x24, 0, 0, 1, 0x30, 0x00, 0, 0, 0, 7, 0x01, 0, 0, 0, 0])
+    assert list(_2f.process_data(response(game_number + raw))) == [("24", 7), ("00", 2)]
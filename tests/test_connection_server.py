@@ -0,0 +1,81 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import time
+
+import pytest
+
+from app.modules.network import connection_server
+
+
+API_KEY = "test-key"
+PAYLOAD = {"action": "jackpot", "data": {"value": 100}}
+
+
+@pytest.fixture(autouse=True)
+def api_key(monkeypatch):
+    monkeypatch.setattr(connection_server, "_BASE_MAC", hmac.new(API_KEY.encode(), digestmod="sha256"))
+
+
+def sign(payload: dict, timestamp: str) -> str:
+    text = json.dumps(payload, separators=(",", ":"), sort_keys=True)
+    return hmac.new(API_KEY.encode(), f"{timestamp}{text}".encode(), hashlib.sha256).hexdigest()
+
+
+def test_good_signature():
+    timestamp = str(int(time.time()))
+    assert connection_server.verify_signature(PAYLOAD, sign(PAYLOAD, timestamp), timestamp)
+
+
+def test_uppercase_signature():
+    timestamp = str(int(time.time()))
+    assert connection_server.verify_signature(PAYLOAD, sign(PAYLOAD, timestamp).upper(), timestamp)
+
+
+def test_wrong_signature():
+    timestamp = str(int(time.time()))
+    other = {**PAYLOAD, "data": {"value": 101}}
+    assert not connection_server.verify_signature(PAYLOAD, sign(other, timestamp), timestamp)
+
+
+@pytest.mark.parametrize("signature", [None, 123, "", "ab", "zz" * 32, "a" * 63, "a" * 65])
+def test_malformed_signature(signature):
+    timestamp = str(int(time.time()))
+    assert not connection_server.verify_signature(PAYLOAD, signature, timestamp)
+
+
+@pytest.mark.parametrize("timestamp", [None, "", "now"])
+def test_missing_timestamp(timestamp):
+    signature = sign(PAYLOAD, str(int(time.time())))
+    assert not connection_server.verify_signature(PAYLOAD, signature, timestamp)
+
+
+def test_stale_timestamp():
+    timestamp = str(int(time.time()) - connection_server.SIGNATURE_SKEW - 10)
+    assert not connection_server.verify_signature(PAYLOAD, sign(PAYLOAD, timestamp), timestamp)
+
+
+def test_no_api_key(monkeypatch):
+    monkeypatch.setattr(connection_server, "_BASE_MAC", None)
+    timestamp = str(int(time.time()))
+    assert not connection_server.verify_signature(PAYLOAD, sign(PAYLOAD, timestamp), timestamp)
+
+
+@pytest.mark.parametrize("message", [b"not json", b"[1, 2]"])
+def test_handle_message_malformed(message, caplog):
+    response = asyncio.run(connection_server.handle_message(message, collector=None))
+    assert response["status"] == 500
+    assert "Failed to handle message" in caplog.text
+
+
+def test_handle_message_action_error(caplog):
+    class Collector:
+        def jackpot(self, value):
+            raise ValueError("value -5 can not be packed into BCD")
+
+    timestamp = str(int(time.time()))
+    message = json.dumps({"payload": PAYLOAD, "signature": sign(PAYLOAD, timestamp), "timestamp": timestamp})
+    response = asyncio.run(connection_server.handle_message(message, Collector()))
+    assert response["status"] == 500
+    assert "can not be packed" in caplog.text
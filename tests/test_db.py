@@ -0,0 +1,304 @@
+import atexit
+import json
+import threading
+import time
+
+import pyodbc
+import pytest
+
+from app.modules import db
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.fast_executemany = False
+        self.closed = False
+
+    def execute(self, query_string, params=None):
+        self.conn.server.calls.append(("execute", query_string, 1))
+        self.conn.run(query_string, [params])
+        return self
+
+    def executemany(self, query_string, rows):
+        self.conn.server.calls.append(("executemany", query_string, len(rows)))
+        self.conn.run(query_string, rows)
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnection:
+    def __init__(self, server):
+        self.server = server
+        self.closed = False
+        self.pending = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def run(self, query_string, rows):
+        for params in rows:
+            if self.server.delay:
+                time.sleep(self.server.delay)
+            state = self.server.errors.get((query_string, tuple(params or ())))
+            if state:
+                raise pyodbc.Error(state, "failed")
+            self.pending.append((query_string, list(params or ())))
+
+    def commit(self):
+        self.server.committed.extend(self.pending)
+        self.pending = []
+
+    def close(self):
+        self.closed = True
+
+
+class FakeServer:
+    """Keeps committed (query_string, params), errors are keyed by (query_string, params)"""
+
+    def __init__(self):
+        self.committed = []
+        self.calls = []
+        self.errors = {}
+        self.down = False
+        self.delay = 0
+        self.connections = []
+
+    def connect(self, *args, **kwargs):
+        if self.down:
+            raise pyodbc.Error("08001", "server is down")
+        conn = FakeConnection(self)
+        self.connections.append(conn)
+        return conn
+
+
+INSERT = db.insert_statement("t", ("a",))
+
+
+@pytest.fixture
+def server(monkeypatch, tmp_path):
+    server = FakeServer()
+    monkeypatch.setattr(db, "open_connection", server.connect)
+    monkeypatch.setattr(db, "cur_dir", str(tmp_path))
+    monkeypatch.setattr(db, "RECONNECT_BASE_DELAY", .001)
+    return server
+
+
+def make_database():
+    database = db.Database("host", "user", "password", "database", "driver")
+    # cur_dir is restored after the test, the queue must not be written there at exit
+    atexit.unregister(database.persist_offline)
+    return database
+
+
+@pytest.fixture
+def database(server):
+    database = make_database()
+    yield database
+    database.stop_threads()
+
+
+def offline_lines(tmp_path, name=db.OFFLINE_FILE):
+    path = tmp_path / name
+    return [json.loads(line) for line in path.read_text().splitlines()] if path.exists() else []
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(.01)
+
+
+def test_save_to_json_keeps_queue_and_file(database, tmp_path):
+    database.save_to_json(INSERT, [1], [2])
+    database.save_to_json("DELETE FROM t")
+    database.persist_offline()
+    expected = [[INSERT, [1]], [INSERT, [2]], "DELETE FROM t"]
+    assert list(database._offline) == expected
+    assert offline_lines(tmp_path) == expected
+
+
+def test_offline_queue_is_read_on_start(server, tmp_path):
+    (tmp_path / db.OFFLINE_FILE).write_text(json.dumps([INSERT, [1]]) + "\n" + '["INSERT INTO t(a) VAL')
+    server.down = True
+    database = make_database()
+    try:
+        # line cut by a crash is skipped
+        assert list(database._offline) == [[INSERT, [1]]]
+    finally:
+        database.stop_threads()
+
+
+def test_replay_on_start(server, tmp_path):
+    (tmp_path / db.OFFLINE_FILE).write_text(
+        "\n".join(json.dumps(q) for q in [[INSERT, [1]], [INSERT, [2]], "DELETE FROM t", [INSERT, [3]]]) + "\n")
+    database = make_database()
+    try:
+        assert server.committed == [(INSERT, [1]), (INSERT, [2]), ("DELETE FROM t", []), (INSERT, [3])]
+        assert not database._offline
+        assert offline_lines(tmp_path) == []
+    finally:
+        database.stop_threads()
+
+
+def test_failed_replay_keeps_queue(database, server, tmp_path):
+    database.save_to_json(INSERT, [1], [2])
+    server.down = True
+    database.connection_is_lost = False
+    database.send_data_json_db()
+    database.stop_threads()
+    assert server.committed == []
+    assert list(database._offline) == [[INSERT, [1]], [INSERT, [2]]]
+    assert offline_lines(tmp_path) == [[INSERT, [1]], [INSERT, [2]]]
+
+
+def test_concurrent_replays_run_once(database, server, tmp_path):
+    database.save_to_json(INSERT, [1], [2])
+    server.delay = .05
+    threads = [threading.Thread(target=database.send_data_json_db) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    time.sleep(.01)
+    database.save_to_json(INSERT, [3])
+    for thread in threads:
+        thread.join()
+    assert server.committed[:2] == [(INSERT, [1]), (INSERT, [2])]
+    # query saved during the first replay is replayed by the second one, nothing twice
+    assert sorted(params for _, params in server.committed) == [[1], [2], [3]]
+    assert not database._offline
+
+
+def test_reconnect_is_started_once(database, server):
+    server.delay = 0
+    server.down = True
+    # several threads fail to open connection before connection_is_lost is seen
+    for _ in range(3):
+        database.connection_is_lost = False
+        database.open()
+    reconnecting = database.threads['r']['thread']
+    assert [t for t in threading.enumerate() if t._target == reconnecting._target] == [reconnecting]
+    database.save_to_json(INSERT, [1])
+    server.down = False
+    wait_for(lambda: not reconnecting.is_alive())
+    assert not database.connection_is_lost
+    assert server.committed == [(INSERT, [1])]
+
+
+def test_replay_groups_same_queries(database, server):
+    other = db.insert_statement("t", ("b",))
+    database.save_to_json(INSERT, [1], [2], [3])
+    database.save_to_json(other, [4])
+    database.save_to_json(INSERT, [5])
+    database.send_data_json_db()
+    assert server.calls == [("executemany", INSERT, 3), ("executemany", other, 1), ("executemany", INSERT, 1)]
+    assert len(server.committed) == 5
+
+
+def test_broken_query_goes_to_dead_letter(database, server, tmp_path):
+    server.errors[(INSERT, (2,))] = "23000"
+    database.save_to_json(INSERT, [1], [2], [3])
+    database.save_to_json("SELEC broken")
+    server.errors[("SELEC broken", ())] = "42000"
+    database.send_data_json_db()
+    assert server.committed == [(INSERT, [1]), (INSERT, [3])]
+    assert offline_lines(tmp_path, db.DEAD_LETTER_FILE) == [[INSERT, [2]], "SELEC broken"]
+    assert not database._offline
+    assert offline_lines(tmp_path) == []
+
+
+def test_connection_error_keeps_queue(database, server):
+    server.errors[(INSERT, (2,))] = "08S01"
+    database.save_to_json(INSERT, [1], [2])
+    server.down = True  # reconnect must not replay during the test
+    database.send_data_json_db()
+    assert database.connection_is_lost
+    assert server.committed == []
+    assert list(database._offline) == [[INSERT, [1]], [INSERT, [2]]]
+
+
+def test_save_failed(database, server, tmp_path):
+    database.save_failed(INSERT, [(1,)], pyodbc.Error("23000", "constraint"))
+    assert offline_lines(tmp_path, db.DEAD_LETTER_FILE) == [[INSERT, [1]]]
+    assert not database._offline
+    server.down = True
+    database.save_failed(INSERT, [(2,)], pyodbc.Error("08S01", "link failure"))
+    assert list(database._offline) == [[INSERT, [2]]]
+
+
+def test_save_failed_after_reconnect(database, server):
+    # connection is back before rows of the failed query are saved
+    database.save_failed(INSERT, [(1,)], pyodbc.Error("08S01", "link failure"))
+    assert server.committed == [(INSERT, [1])]
+    assert not database._offline
+
+
+def test_lost_connection_is_replayed_after_reconnect(database, server):
+    server.errors[(INSERT, (1,))] = "08S01"
+    with pytest.raises(pyodbc.Error):
+        database.insert_many("t", ["a"], [[1]])
+    # connection is marked as lost, reconnect may already be done
+    assert 'r' in database.threads
+    del server.errors[(INSERT, (1,))]
+    database.save_failed(INSERT, [[1]], pyodbc.Error("08S01", "link failure"))
+    wait_for(lambda: not database._offline and not database.connection_is_lost)
+    assert server.committed == [(INSERT, [1])]
+
+
+def test_legacy_offline_file_is_imported(server, tmp_path):
+    (tmp_path / db.OFFLINE_FILE).write_text(json.dumps([INSERT, [2]]) + "\n")
+    (tmp_path / db.LEGACY_OFFLINE_FILE).write_text(json.dumps(["INSERT INTO t(a) VALUES (1)"]))
+    server.down = True
+    database = make_database()
+    try:
+        assert list(database._offline) == ["INSERT INTO t(a) VALUES (1)", [INSERT, [2]]]
+        assert offline_lines(tmp_path) == list(database._offline)
+        assert not (tmp_path / db.LEGACY_OFFLINE_FILE).exists()
+    finally:
+        database.stop_threads()
+
+
+def test_offline_buffer_is_flushed_in_time(monkeypatch, database, tmp_path):
+    monkeypatch.setattr(db, "OFFLINE_FLUSH_SECONDS", .05)
+    database.stop_threads()
+    database = make_database()
+    try:
+        database.save_to_json(INSERT, [1])
+        wait_for(lambda: offline_lines(tmp_path) == [[INSERT, [1]]])
+    finally:
+        database.stop_threads()
+
+
+def test_pool_reuses_connection(database, server):
+    database.select("t", ["a"])
+    database.select("t", ["a"])
+    assert len(server.connections) == 1
+
+
+def test_pool_keeps_at_most_pool_size(database, server):
+    pairs = [database.open() for _ in range(db.POOL_SIZE + 2)]
+    for pair in pairs:
+        database.close(*pair)
+    assert database._pool.qsize() == db.POOL_SIZE
+    assert sum(conn.closed for conn, _ in pairs) == 2
+
+
+def test_pool_drops_closed_connection(database, server):
+    database.select("t", ["a"])
+    server.connections[0].closed = True
+    database.select("t", ["a"])
+    assert len(server.connections) == 2
+
+
+def test_stale_pooled_connection_is_retried(database, server):
+    database.select("t", ["a"])
+    stale = server.connections[0]
+    stale.run = lambda query_string, rows: (_ for _ in ()).throw(pyodbc.Error("08S01", "dropped"))
+    database.insert_many("t", ["a"], [[1]])
+    assert stale.closed
+    assert [q for q in server.committed if q[0] == INSERT] == [(INSERT, [1])]
+    assert not database.connection_is_lost
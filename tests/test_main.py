@@ -0,0 +1,79 @@
+import threading
+
+import pyodbc
+import pytest
+
+from app import main
+from app.modules.db import insert_statement
+
+
+INSERT = insert_statement("gaming_transactions", main.GAMING_TRANSACTIONS_COLUMNS)
+
+
+class FakeDatabase:
+    def __init__(self, insert_error=None, save_error=None, job_error=None):
+        self.insert_error, self.save_error, self.job_error = insert_error, save_error, job_error
+        self.inserted, self.failed, self.jobs = [], [], 0
+
+    def insert_many(self, table, columns, rows):
+        if self.insert_error:
+            raise self.insert_error
+        self.inserted.extend(rows)
+
+    def save_failed(self, query_string, rows, error):
+        if self.save_error:
+            raise self.save_error
+        self.failed.append((query_string, list(rows), error))
+
+    def start_job(self):
+        self.jobs += 1
+        if self.job_error:
+            raise self.job_error
+
+
+def flush(commands, rows):
+    commands.save_transactions(rows)
+    done = threading.Thread(target=commands.flush, daemon=True)
+    done.start()
+    done.join(5)
+    assert not done.is_alive(), "flush() did not return"
+
+
+@pytest.fixture
+def commands(monkeypatch):
+    def make(db):
+        monkeypatch.setattr(main, "INSERT_FLUSH_MS", 10)
+        return main.Commands(db, collector=None)
+    return make
+
+
+def test_rows_are_inserted_in_one_batch(commands):
+    db = FakeDatabase()
+    flush(commands(db), [(1,), (2,)])
+    assert db.inserted == [(1,), (2,)]
+    assert db.failed == []
+    assert db.jobs == 1
+
+
+def test_failed_insert_is_saved(commands):
+    error = pyodbc.Error("08S01", "link failure")
+    db = FakeDatabase(insert_error=error)
+    flush(commands(db), [(1,), (2,)])
+    assert db.failed == [(INSERT, [(1,), (2,)], error)]
+    assert db.jobs == 0
+
+
+def test_job_error_does_not_save_committed_rows(commands):
+    db = FakeDatabase(job_error=pyodbc.Error("HY000", "job failed"))
+    flush(commands(db), [(1,), (2,)])
+    assert db.inserted == [(1,), (2,)]
+    assert db.failed == []
+
+
+def test_flusher_survives_failed_save(commands):
+    db = FakeDatabase(insert_error=pyodbc.Error("23000", "constraint"), save_error=OSError("disk full"))
+    c = commands(db)
+    flush(c, [(1,)])
+    db.insert_error = db.save_error = None
+    flush(c, [(2,)])
+    assert db.inserted == [(2,)]